@@ -26,9 +26,14 @@ setup(name="pipelinewise-target-s3-csv",
           'pipelinewise-singer-python==1.*',
           'inflection==0.5.1',
           'boto3==1.17.39',
-          'pyarrow==10.0.1'
+          'pyarrow==10.0.1',
+          'orjson==3.8.*',
+          'ciso8601==2.*'
       ],
       extras_require={
+          "isal": [
+              'isal==1.*',
+          ],
           "test": [
               'pylint==2.10.*',
               'pytest==6.2.*',
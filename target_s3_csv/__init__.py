@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
-import io
 import json
 import os
 import sys
 import tempfile
+import ciso8601
+import orjson
+import simplejson
 import singer
 
 from singer.messages import RecordMessage
-from datetime import datetime
+from datetime import date, datetime, timezone
 from jsonschema import Draft7Validator, FormatChecker
 
 from target_s3_csv import s3
@@ -21,10 +23,79 @@ from target_s3_csv.file_handlers import FileHandler, ParquetFileHandler, CSVFile
 LOGGER = singer.get_logger('target_s3_csv')
 DEFAULT_BATCH_SIZE = 100_000 
 
+# Compiled validators shared by every stream with an identical schema
+_VALIDATOR_CACHE = {}
+
+# One format checker shared by every validator, with C based date parsers
+# in place of the default regex and strptime based checks
+_FORMAT_CHECKER = FormatChecker()
+
+
+@_FORMAT_CHECKER.checks('date-time', raises=ValueError)
+def is_datetime(instance):
+    if isinstance(instance, str):
+        ciso8601.parse_rfc3339(instance)
+    return True
+
+
+@_FORMAT_CHECKER.checks('date', raises=ValueError)
+def is_date(instance):
+    if isinstance(instance, str):
+        date.fromisoformat(instance)
+    return True
+
+REQUIRED_MESSAGE_KEYS = {
+    'RECORD': ('stream', 'record'),
+    'SCHEMA': ('stream', 'schema', 'key_properties'),
+    'STATE': ('value',),
+}
+
+
+def contains_float(value):
+    """Tells if a parsed JSON object or array holds a float at any depth"""
+    for child in value.values() if value.__class__ is dict else value:
+        child_class = child.__class__
+        if child_class is float:
+            return True
+        if (child_class is dict or child_class is list) and contains_float(child):
+            return True
+    return False
+
+
+def parse_message(message):
+    """Parses a singer message into a dictionary
+
+    Bypasses singer.parse_message and its per-type message objects, but keeps
+    the same required key checks as the singer spec. Messages with floats,
+    including integers too wide for 64 bits, are parsed again into Decimals
+    to keep their exact values. Invalid JSON raises orjson.JSONDecodeError.
+    """
+    try:
+        parsed_message = orjson.loads(message)
+    except orjson.JSONDecodeError as error:
+        # Integers wider than 64 bits, if orjson rejects them
+        try:
+            parsed_message = simplejson.loads(message, use_decimal=True)
+        except simplejson.JSONDecodeError:
+            raise error from None
+    else:
+        if isinstance(parsed_message, dict) and contains_float(parsed_message):
+            parsed_message = simplejson.loads(message, use_decimal=True)
+    if not isinstance(parsed_message, dict):
+        raise Exception('Message is not a JSON object: {}'.format(message))
+    message_type = parsed_message.get('type')
+    if message_type is None:
+        raise Exception("Message is missing required key 'type': {}".format(message))
+    for key in REQUIRED_MESSAGE_KEYS.get(message_type, ()):
+        if key not in parsed_message:
+            raise Exception("Message is missing required key '{}': {}".format(key, message))
+    return parsed_message
+
+
 def emit_state(state):
     if state is not None:
-        line = json.dumps(state)
-        LOGGER.debug('Emitting state {}'.format(line))
+        line = simplejson.dumps(state, use_decimal=True)
+        LOGGER.debug('Emitting state %s', line)
         sys.stdout.write("{}\n".format(line))
         sys.stdout.flush()
 
@@ -34,24 +105,37 @@ class TargetS3Parquet:
         self.config = config
         self.s3_client = s3_client
         self.schemas = {}
+        self.schema_keys = {}
+        self.key_properties = {}
         self.validators = {}
+        self.flatten_plans = {}
         self.filenames = {}
         self.headers = {}
-        self.file_handler = CSVFileHandler(self)
-
+        # Resolved once, these are used for every record
+        self.add_metadata_columns = bool(config.get('add_metadata_columns'))
+        self.skip_validation = bool(config.get('skip_validation'))
+        self.stream_upload = bool(config.get('stream_upload'))
+        self.batch_size = int(config.get('default_batch_size', DEFAULT_BATCH_SIZE))
+        self.temp_dir = os.path.expanduser(config.get('temp_dir', tempfile.gettempdir()))
+        if self.temp_dir:
+            os.makedirs(self.temp_dir, exist_ok=True)
+        if config.get('format') == 'parquet':
+            self.file_handler = ParquetFileHandler(self)
+        else:
+            self.file_handler = CSVFileHandler(self)
 
-    @property
-    def temp_dir(self):
-        temp_dir = os.path.expanduser(self.config.get('temp_dir', tempfile.gettempdir()))
-        if temp_dir:
-            os.makedirs(temp_dir, exist_ok=True)
-        return temp_dir
+    def get_validator(self, schema):
+        key = orjson.dumps(schema, default=str, option=orjson.OPT_SORT_KEYS)
+        if key not in _VALIDATOR_CACHE:
+            _VALIDATOR_CACHE[key] = Draft7Validator(utils.float_to_decimal(schema), format_checker=_FORMAT_CHECKER)
+        return _VALIDATOR_CACHE[key]
 
     def validate_message(self, message):
-        stream_name = message["stream"]
-        float_to_decimal_record = utils.float_to_decimal(message['record'])
+        if self.skip_validation:
+            return
+        # parse_message already turns every non-integer number into a Decimal
         try:
-            self.validators[stream_name].validate(float_to_decimal_record)
+            self.validators[message['stream']].validate(message['record'])
         except Exception as e:
             if type(e).__name__ == "InvalidOperation":
                 LOGGER.error(errors.VALIDATION_ERROR)
@@ -61,12 +145,10 @@ class TargetS3Parquet:
         stream_name = message['stream']
         
         if stream_name in self.filenames:
-            filename = self.filenames[stream_name]['filename']
-            if os.path.exists(filename):
-                return filename
+            return self.filenames[stream_name]['filename']
 
         now = datetime.now().strftime('%Y%m%dT%H%M%S.%f')[:-3]
-        filename = os.path.expanduser(os.path.join(self.temp_dir, stream_name + '-' + now + self.file_handler.suffix))
+        filename = os.path.join(self.temp_dir, stream_name + '-' + now + self.file_handler.suffix)
 
         self.filenames[stream_name] = {
             'filename': filename,
@@ -87,68 +169,107 @@ class TargetS3Parquet:
             raise Exception(errors.SCHEMA_ERROR.format(stream_name))
         self.validate_message(message)
         record_to_load = message['record']
-        if self.config.get('add_metadata_columns'):
+        if self.add_metadata_columns:
             record_to_load = utils.add_metadata_values_to_record(message, {}, self._sdc_batched_at)
         else:
             record_to_load = utils.remove_metadata_values_from_record(message)
         filename = self.get_filename(message)
-        flattened_record = utils.flatten_record(record_to_load)
+        flattened_record = utils.flatten_record_with_plan(record_to_load, self.flatten_plans[stream_name])
         self.file_handler.write_record_to_file(stream_name, filename, flattened_record)
 
 
+    def open_upload(self, stream_name):
+        """Opens a multipart upload to the S3 key of the current file of the stream"""
+        return s3.MultipartUploadWriter(
+            self.s3_client,
+            self.config['s3_bucket'],
+            self.filenames[stream_name]['target_key'],
+            self.config.get("compression"),
+            self.config.get('encryption_type'), self.config.get('encryption_key')
+            )
+
+    def process_message_schema(self, message):
+        stream_name = message['stream']
+        self.key_properties[stream_name] = message['key_properties']
+
+        # Producers re-send the same SCHEMA message, e.g. when resuming a sync
+        schema_key = orjson.dumps(message['schema'], default=str, option=orjson.OPT_SORT_KEYS)
+        if self.schema_keys.get(stream_name) == schema_key:
+            return
+        self.schema_keys[stream_name] = schema_key
+
+        if self.add_metadata_columns:
+            message = utils.add_metadata_columns_to_schema(message)
+        schema = message['schema']
+        self.schemas[stream_name] = schema
+
+        self.validators[stream_name] = self.get_validator(schema)
+        exclude = () if self.add_metadata_columns else utils.METADATA_COLUMNS
+        self.flatten_plans[stream_name] = utils.compile_flatten_plan(schema, exclude=exclude)
+        self.file_handler.set_schema(stream_name, utils.flatten_schema(schema, exclude=exclude))
+
+    def upload_batch(self):
+        self.file_handler.close()
+        # Streamed files are uploaded by the time the file handler is closed
+        if not self.stream_upload:
+            s3.upload_files(
+                iter(self.filenames.values()),
+                self.s3_client,
+                self.config['s3_bucket'],
+                self.config.get("compression"),
+                self.config.get('encryption_type'), self.config.get('encryption_key'),
+                self.config.get('s3_upload_workers')
+                )
+        self.filenames = {}
+
     def persist_messages(self, messages):
         state = None
-        key_properties = {}
         row_count = 0
         total_batches = 0
-        self._sdc_batched_at = datetime.now().isoformat()
-        for message in messages:
-            try:
-                parsed_message: dict = singer.parse_message(message).asdict()
-            except json.decoder.JSONDecodeError:
-                LOGGER.error("Unable to parse:\n{}".format(message))
-                raise
-            message_type = parsed_message['type']
-            if message_type == 'RECORD':
-                self.process_message_record(parsed_message)
-                row_count += 1
-            elif message_type == 'STATE':
-                LOGGER.debug('Setting state to {}'.format(parsed_message['value']))
-                state = parsed_message['value']
-
-            elif message_type == 'SCHEMA':
-                stream_name = parsed_message['stream']
-                self.schemas[stream_name] = parsed_message['schema']
-
-                if self.config.get('add_metadata_columns'):
-                    self.schemas[stream_name] = utils.add_metadata_columns_to_schema(parsed_message)
-
-                schema = utils.float_to_decimal(parsed_message['schema'])
-                self.validators[stream_name] = Draft7Validator(schema, format_checker=FormatChecker())
-                key_properties[stream_name] = parsed_message['key_properties']
-            elif message_type == 'ACTIVATE_VERSION':
-                LOGGER.debug('ACTIVATE_VERSION message')
-            else:
-                LOGGER.warning("Unknown message type {} in message {}".format(parsed_message['type'], parsed_message))
-
-            if row_count == self.config.get("default_batch_size", DEFAULT_BATCH_SIZE):
-                s3.upload_files(
-                    iter(self.filenames.values()), 
-                    self.s3_client, 
-                    self.config['s3_bucket'], 
-                    self.config.get("compression"),
-                    self.config.get('encryption_type'), self.config.get('encryption_key'), self.config.get('format')
-                    )
-                if state is not None:
-                    emit_state(state)
-                row_count = 0
-                total_batches += 1
-                LOGGER.info(f"total batches is {total_batches}")
-                self._sdc_batched_at = datetime.now().isoformat()
-        if row_count > 0:
-            s3.upload_files(iter(self.filenames.values()), self.s3_client, self.config['s3_bucket'], self.config.get("compression"),
-                            self.config.get('encryption_type'), self.config.get('encryption_key'), self.config.get('format'))
-            emit_state(state)
+        self._sdc_batched_at = datetime.now(timezone.utc).isoformat()
+        # Local names for everything used per RECORD message
+        parse = parse_message
+        process_message_record = self.process_message_record
+        batch_size = self.batch_size
+        try:
+            for message in messages:
+                try:
+                    parsed_message: dict = parse(message)
+                except orjson.JSONDecodeError:
+                    LOGGER.error("Unable to parse:\n%s", message)
+                    raise
+                message_type = parsed_message['type']
+                if message_type == 'RECORD':
+                    process_message_record(parsed_message)
+                    row_count += 1
+                    # Only RECORD messages can fill a batch
+                    if row_count >= batch_size:
+                        self.upload_batch()
+                        if state is not None:
+                            emit_state(state)
+                        row_count = 0
+                        total_batches += 1
+                        LOGGER.info("total batches is %s", total_batches)
+                        self._sdc_batched_at = datetime.now(timezone.utc).isoformat()
+                elif message_type == 'STATE':
+                    LOGGER.debug('Setting state to %s', parsed_message['value'])
+                    state = parsed_message['value']
+
+                elif message_type == 'SCHEMA':
+                    self.process_message_schema(parsed_message)
+                elif message_type == 'ACTIVATE_VERSION':
+                    LOGGER.debug('ACTIVATE_VERSION message')
+                else:
+                    LOGGER.warning("Unknown message type %s in message %s", parsed_message['type'], parsed_message)
+
+            if row_count > 0:
+                self.upload_batch()
+                emit_state(state)
+        except Exception:
+            # Leave no incomplete multipart uploads behind
+            self.file_handler.abort()
+            raise
+        return state
 
 
 
@@ -170,7 +291,8 @@ def main():
 
     s3_client = s3.create_client(config)
 
-    input_messages = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    # orjson parses UTF-8 bytes natively, no need to decode the lines first
+    input_messages = sys.stdin.buffer
 
     target = TargetS3Parquet(config, s3_client)
     target.persist_messages(input_messages)
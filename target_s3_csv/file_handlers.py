@@ -1,13 +1,253 @@
-import os
-import csv
-import pyarrow as pa
+import contextlib
 import io
-import json
+import re
+import ciso8601
+import orjson
+import simplejson
+import singer
+import pyarrow as pa
 from pyarrow import json as pa_json
 from pyarrow.parquet import ParquetWriter
 from abc import ABC
+from decimal import Decimal
+
+LOGGER = singer.get_logger('target_s3_csv')
+
+# Number of rows buffered per stream before they are written in one call
+ROW_BUFFER_SIZE = 10_000
+# Number of rows written to a parquet file as one row group
+ROW_GROUP_SIZE = 64_000
+# Maximum size of the JSON buffered for one row group, the arrow JSON reader
+# reads it as a single block whose size must fit in 32 bits
+ROW_GROUP_BUFFER_SIZE = 512 * 1024 * 1024
+
+ARROW_TYPES = {
+    'integer': pa.int64(),
+    'number': pa.float64(),
+    'boolean': pa.bool_(),
+    'string': pa.string(),
+    # flatten_record serialises arrays to JSON strings
+    'array': pa.string(),
+}
+
+
+TIMESTAMP_TYPE = pa.timestamp('us', tz='UTC')
+
+
+def get_arrow_type(json_type, prop):
+    """Returns the arrow type of a JSON schema property with a single type"""
+    if json_type == 'string':
+        if prop.get('format') == 'date-time':
+            return TIMESTAMP_TYPE
+        if prop.get('enum'):
+            # Low cardinality columns are stored as indices into the enum values.
+            # The index is wide enough for values outside the enum as well
+            return pa.dictionary(pa.int32(), pa.string())
+    return ARROW_TYPES[json_type]
+
+
+def get_single_type(prop):
+    """Returns the only non-null JSON type of a property if arrow has a type for it"""
+    json_types = prop.get('type', [])
+    if isinstance(json_types, str):
+        json_types = [json_types]
+    json_types = [t for t in json_types if t != 'null']
+    if len(json_types) == 1 and json_types[0] in ARROW_TYPES:
+        return json_types[0]
+    return None
+
+
+def create_arrow_schema(flattened_schema):
+    """Builds an arrow schema from a flattened JSON schema
+
+    Columns without a single known JSON type, e.g. with mixed types or no
+    type at all, are string columns holding JSON, see get_typed_columns.
+    """
+    fields = []
+    for name, prop in flattened_schema.items():
+        json_type = get_single_type(prop)
+        if json_type is not None:
+            fields.append(pa.field(name, get_arrow_type(json_type, prop)))
+        else:
+            fields.append(pa.field(name, pa.string()))
+    return pa.schema(fields)
+
+
+def get_typed_columns(flattened_schema):
+    """Returns the columns of a flattened JSON schema with a single known type.
+    The arrow JSON reader cannot mix types in one column, so the values of
+    every other column, including those not in the schema, are written as
+    JSON strings"""
+    return frozenset(name for name, prop in flattened_schema.items() if get_single_type(prop) is not None)
+
+
+def get_json_read_schema(schema):
+    """Replaces the dictionary types of an arrow schema with their value types,
+    the arrow JSON reader cannot build dictionary arrays"""
+    if schema is None:
+        return None
+    return pa.schema([
+        field.with_type(field.type.value_type) if pa.types.is_dictionary(field.type) else field
+        for field in schema
+    ])
+
+
+def cast_columns(table, schema):
+    """Casts the columns of a table read by get_json_read_schema back to the
+    dictionary types of the schema, and null columns to strings"""
+    for index, field in enumerate(table.schema):
+        # Columns only ever null in the first row group must not lock the file to the null type
+        if pa.types.is_null(field.type):
+            table = table.set_column(index, field.with_type(pa.string()), table.column(index).cast(pa.string()))
+    if schema is None:
+        return table
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            index = table.schema.get_field_index(field.name)
+            table = table.set_column(index, field, table.column(index).cast(field.type))
+    return table
+
+
+def to_json_string(value):
+    """Returns the JSON text of a value, strings are kept as they are"""
+    if value.__class__ is str:
+        return value
+    if value.__class__ in (int, Decimal):
+        return str(value)
+    return orjson.dumps(value).decode()
+
+
+def to_int64(value):
+    if value.__class__ is bool:
+        raise TypeError(value)
+    number = Decimal(value) if value.__class__ is str else value
+    integer = int(number)
+    if integer != number or not -2 ** 63 <= integer < 2 ** 63:
+        raise ValueError(value)
+    return integer
+
+
+def to_float64(value):
+    if value.__class__ is bool:
+        raise TypeError(value)
+    return float(value)
+
+
+def to_bool(value):
+    if value.__class__ is bool:
+        return value
+    if value.__class__ is str and value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    raise ValueError(value)
+
+
+def get_converter(arrow_type):
+    """Returns the function converting a JSON value to an arrow type"""
+    if pa.types.is_timestamp(arrow_type):
+        return ciso8601.parse_datetime
+    if pa.types.is_integer(arrow_type):
+        return to_int64
+    if pa.types.is_floating(arrow_type):
+        return to_float64
+    if pa.types.is_boolean(arrow_type):
+        return to_bool
+    return to_json_string
 
 
+def convert_column(field, values, string_fallback):
+    """Converts the values of a column one by one, values that do not fit the
+    type of the field are written as nulls. With string_fallback, such a
+    column is turned into a string column instead, unless it holds date-times"""
+    convert = get_converter(field.type)
+    converted = []
+    invalid_count = 0
+    for value in values:
+        if value is not None:
+            try:
+                value = convert(value)
+            except (ValueError, TypeError, ArithmeticError):
+                value = None
+                invalid_count += 1
+        converted.append(value)
+    if invalid_count and string_fallback and not pa.types.is_timestamp(field.type):
+        LOGGER.warning('Column %s has values that are not %s, it is written as strings', field.name, field.type)
+        return field.with_type(pa.string()), pa.array([None if v is None else to_json_string(v) for v in values],
+                                                      pa.string())
+    if invalid_count:
+        LOGGER.warning('%s values of column %s are not %s and are written as nulls',
+                       invalid_count, field.name, field.type)
+    if pa.types.is_dictionary(field.type):
+        return field, pa.array(converted, field.type.value_type).cast(field.type)
+    return field, pa.array(converted, field.type)
+
+
+def convert_records(buffer, schema, first_row_group):
+    """Builds a table from a row group the arrow JSON reader rejected, e.g.
+    with values of another type than their column or integers wider than 64
+    bits. In the first row group of a file columns with such values become
+    string columns and columns outside the schema are added, later row groups
+    must match the schema of the file"""
+    records = [simplejson.loads(line, use_decimal=True) for line in bytes(buffer).split(b'\n') if line]
+    fields = list(schema)
+    if first_row_group:
+        names = set(schema.names)
+        for record in records:
+            for name in record.keys() - names:
+                fields.append(pa.field(name, pa.string()))
+                names.add(name)
+    columns = [
+        convert_column(field, [record.get(field.name) for record in records], first_row_group)
+        for field in fields
+    ]
+    return pa.Table.from_arrays([array for _, array in columns], schema=pa.schema([field for field, _ in columns]))
+
+
+def create_row_formatter(header, delimiter=',', quotechar='"'):
+    """Generates a function that formats a record as one CSV line of the given
+    header
+
+    The output is the same as csv.DictWriter with the default excel dialect:
+    fields are quoted only if they contain special characters and missing
+    fields are empty. Lines without any special character are joined in one
+    go, the others are quoted field by field.
+    """
+    special_characters = re.compile('[{}]'.format(re.escape(delimiter + quotechar + '\r\n')))
+    quote_characters = re.compile('[{}]'.format(re.escape(quotechar + '\r\n')))
+    escaped_quotechar = quotechar * 2
+
+    def quote(value):
+        if value is None:
+            return ''
+        if value.__class__ is not str:
+            value = str(value)
+        if special_characters.search(value):
+            return quotechar + value.replace(quotechar, escaped_quotechar) + quotechar
+        return value
+
+    # csv quotes the empty field of a single column row to tell it from an empty line
+    empty_line = escaped_quotechar if len(header) == 1 else ''
+    source = (
+        'def format_row(record):\n'
+        '    get = record.get\n'
+        '    values = [{values}]\n'
+        "    line = delimiter.join(['' if v is None else v if v.__class__ is str else str(v) for v in values])\n"
+        '    if line and line.count(delimiter) == {delimiters} and not quote_characters.search(line):\n'
+        '        return line + {lineterminator!r}\n'
+        '    return (delimiter.join([quote(v) for v in values]) or empty_line) + {lineterminator!r}\n'
+    ).format(
+        values=', '.join('get({!r})'.format(column) for column in header),
+        delimiters=len(header) - 1,
+        lineterminator='\r\n'
+    )
+    namespace = {
+        'delimiter': delimiter,
+        'quote': quote,
+        'quote_characters': quote_characters,
+        'empty_line': empty_line,
+    }
+    exec(source, namespace)  # pylint: disable=exec-used
+    return namespace['format_row']
+
 
 class FileHandler(ABC):
     def __init__(self, target) -> None:
@@ -18,59 +258,178 @@ class FileHandler(ABC):
     def write_record_to_file(self, stream_name, filename, record):
         ...
 
+    def set_schema(self, stream_name, flattened_schema):
+        """Receives the flattened schema of every SCHEMA message"""
+
+    def close(self):
+        """Flushes and closes every open file so that they can be uploaded"""
+
+    def abort(self):
+        """Closes every open file after an error, aborting streamed uploads"""
+
 
 
 class CSVFileHandler(FileHandler):
     def __init__(self, target):
         self.suffix = ".csv"
         self.target = target
+        self.delimiter = target.config.get('delimiter', ',')
+        self.quotechar = target.config.get('quotechar', '"')
+        self._open_files = {}
+        self._headers_written = set()
 
-    def write_record_to_file(self, stream_name, filename, record) -> None:
-        file_is_empty = (not os.path.isfile(filename)) or os.stat(filename).st_size == 0
-        delimiter = self.target.config.get('delimiter', ',')
-        quotechar = self.target.config.get('quotechar', '"')
-        if stream_name not in self.target.headers and not file_is_empty:
-            with open(filename, 'r') as csvfile:
-                reader = csv.reader(
-                    csvfile,
-                    delimiter=delimiter,
-                    quotechar=quotechar
-                    )
-                first_line = next(reader)
-                self.target.headers[stream_name] = first_line if first_line else record.keys()
-        else:
+    def open_file(self, stream_name, filename, record):
+        file_is_empty = filename not in self._headers_written
+        if file_is_empty:
             self.target.headers[stream_name] = record.keys()
-        with open(filename, 'a') as csvfile:
-            writer = csv.DictWriter(
-                csvfile,
-                self.target.headers[stream_name],
-                extrasaction='ignore',
-                delimiter=delimiter,
-                quotechar=quotechar
-                )
-            if file_is_empty:
-                writer.writeheader()
+        if self.target.stream_upload:
+            csvfile = io.TextIOWrapper(self.target.open_upload(stream_name), encoding='utf-8', newline='')
+        else:
+            # Kept open for the whole batch and closed by close_file
+            csvfile = open(filename, 'a', buffering=1 << 20, newline='')  # pylint: disable=consider-using-with
+        header = list(self.target.headers[stream_name])
+        format_row = create_row_formatter(header, self.delimiter, self.quotechar)
+        if file_is_empty:
+            csvfile.write(format_row(dict(zip(header, header))))
+            self._headers_written.add(filename)
+        self._open_files[stream_name] = (filename, csvfile, format_row, [])
+        return self._open_files[stream_name]
+
+    @staticmethod
+    def write_rows(open_file):
+        _, csvfile, format_row, rows = open_file
+        csvfile.write(''.join(map(format_row, rows)))
+        rows.clear()
+
+    def close_file(self, open_file):
+        self.write_rows(open_file)
+        open_file[1].close()
+
+    def write_record_to_file(self, stream_name, filename, record) -> None:
+        open_file = self._open_files.get(stream_name)
+        if open_file is None or open_file[0] != filename:
+            if open_file is not None:
+                self.close_file(open_file)
+            open_file = self.open_file(stream_name, filename, record)
+        rows = open_file[3]
+        rows.append(record)
+        if len(rows) >= ROW_BUFFER_SIZE:
+            self.write_rows(open_file)
+
+    def close(self):
+        for open_file in self._open_files.values():
+            self.close_file(open_file)
+        self._open_files = {}
+        self._headers_written = set()
 
-            writer.writerow(record)
+    def abort(self):
+        for open_file in self._open_files.values():
+            csvfile = open_file[1]
+            if self.target.stream_upload:
+                # The text wrapper is closed along with its aborted upload
+                csvfile.buffer.abort()
+            else:
+                csvfile.close()
+        self._open_files = {}
+        self._headers_written = set()
 
 
 class ParquetFileHandler(FileHandler):
     def __init__(self, target):
         self.suffix = ".parquet"
         self.target = target
-        self.writer = None
+        self._buffers = {}
+        self._row_counts = {}
+        self._writers = {}
+        self._uploads = []
+        self._arrow_schemas = {}
+        self._typed_columns = {}
+
+    def set_schema(self, stream_name, flattened_schema):
+        self._arrow_schemas[stream_name] = create_arrow_schema(flattened_schema)
+        self._typed_columns[stream_name] = get_typed_columns(flattened_schema)
+
+    def write_batch(self, stream_name, filename):
+        buffer = self._buffers.get(stream_name)
+        if not buffer:
+            return
+        writer = self._writers.get(stream_name)
+        if writer is None:
+            schema = self._arrow_schemas.get(stream_name)
+            unexpected_field_behavior = 'infer'
+        else:
+            schema = writer.schema
+            unexpected_field_behavior = 'ignore'
+        try:
+            table = pa_json.read_json(
+                pa.py_buffer(buffer),
+                read_options=pa_json.ReadOptions(block_size=len(buffer)),
+                parse_options=pa_json.ParseOptions(
+                    explicit_schema=get_json_read_schema(schema),
+                    unexpected_field_behavior=unexpected_field_behavior
+                    )
+                )
+            table = cast_columns(table, schema)
+        except pa.ArrowInvalid as error:
+            if schema is None:
+                raise
+            LOGGER.info('Converting the values of stream %s one by one: %s', stream_name, error)
+            table = convert_records(buffer, schema, writer is None)
+            # Values of the columns turned into strings are written as JSON strings from now on
+            self._typed_columns[stream_name] = self._typed_columns[stream_name].difference(
+                field.name for field in table.schema if pa.types.is_string(field.type)
+                )
+        if writer is None:
+            if self.target.stream_upload:
+                sink = self.target.open_upload(stream_name)
+                self._uploads.append(sink)
+            else:
+                sink = filename
+            writer = ParquetWriter(sink, table.schema, compression='zstd', compression_level=3, use_dictionary=True)
+            self._writers[stream_name] = writer
+        writer.write_table(table)
+        self._buffers[stream_name] = bytearray()
+        self._row_counts[stream_name] = 0
 
     def write_record_to_file(self, stream_name, filename, record):
-        json_data = io.BytesIO(bytes(json.dumps(record), encoding="utf-8"))
-        table = pa_json.read_json(json_data)
-        if self.writer is None:
-            self.writer =  ParquetWriter(
-                filename, table.schema
-            )
+        buffer = self._buffers.get(stream_name)
+        if buffer is None:
+            buffer = self._buffers[stream_name] = bytearray()
+            self._row_counts[stream_name] = 0
+        for column in record.keys() - self._typed_columns.get(stream_name, frozenset()):
+            value = record[column]
+            if value is not None and value.__class__ is not str:
+                record[column] = to_json_string(value)
         try:
-            self.writer.write_table(table)
-        except ValueError:
-            self.writer =  ParquetWriter(
-                filename, table.schema
-            )
-            self.writer.write_table(table)
+            buffer += orjson.dumps(record, default=float)
+        except TypeError:
+            # Integers wider than 64 bits
+            buffer += simplejson.dumps(record, use_decimal=True).encode()
+        buffer += b'\n'
+        self._row_counts[stream_name] += 1
+        if self._row_counts[stream_name] >= ROW_GROUP_SIZE or len(buffer) >= ROW_GROUP_BUFFER_SIZE:
+            self.write_batch(stream_name, filename)
+
+    def close(self):
+        for stream_name in self._buffers:
+            self.write_batch(stream_name, self.target.filenames[stream_name]['filename'])
+        for writer in self._writers.values():
+            writer.close()
+        for upload in self._uploads:
+            upload.close()
+        self._buffers = {}
+        self._row_counts = {}
+        self._writers = {}
+        self._uploads = []
+
+    def abort(self):
+        # Closing a writer only writes the parquet footer, it does not complete the upload
+        for writer in self._writers.values():
+            with contextlib.suppress(Exception):
+                writer.close()
+        for upload in self._uploads:
+            upload.abort()
+        self._buffers = {}
+        self._row_counts = {}
+        self._writers = {}
+        self._uploads = []
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
-import gzip
+import io
 import os
 import shutil
 import backoff
 import boto3
 import singer
-from pyarrow import csv as pa_csv, parquet
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Tuple, List, Dict, Iterator
 from botocore.client import BaseClient
 from botocore.exceptions import ClientError
 
+try:
+    # ISA-L based gzip compression is several times faster than zlib, if installed
+    from isal import igzip as gzip, isal_zlib as zlib
+except ImportError:
+    import gzip
+    import zlib
+
 LOGGER = singer.get_logger('target_s3_csv')
+DEFAULT_UPLOAD_WORKERS = 8
+# Size of the parts sent by multipart uploads, S3 requires at least 5 MiB
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
 
 
 def retry_pattern():
@@ -53,11 +63,8 @@ def create_client(config):
     return s3
 
 
-# pylint: disable=too-many-arguments
-@retry_pattern()
-def upload_file(filename, s3_client, bucket, s3_key,
-                encryption_type=None, encryption_key=None):
-
+def get_encryption_args(encryption_type=None, encryption_key=None):
+    """Returns the extra S3 arguments and a log description of the given encryption"""
     if encryption_type is None or encryption_type.lower() == "none":
         # No encryption config (defaults to settings on the bucket):
         encryption_desc = ""
@@ -79,65 +86,181 @@ def upload_file(filename, s3_client, bucket, s3_key,
                 "Expected: 'none' or 'KMS'"
                 .format(encryption_type)
             )
-    LOGGER.info(
-        "Uploading {} to bucket {} at {}{}"
-        .format(filename, bucket, s3_key, encryption_desc)
-    )
+    return encryption_args, encryption_desc
+
+
+# pylint: disable=too-many-arguments
+@retry_pattern()
+def upload_file(filename, s3_client, bucket, s3_key,
+                encryption_type=None, encryption_key=None):
+
+    encryption_args, encryption_desc = get_encryption_args(encryption_type, encryption_key)
+    LOGGER.info("Uploading %s to bucket %s at %s%s", filename, bucket, s3_key, encryption_desc)
     s3_client.upload_file(filename, bucket, s3_key, ExtraArgs=encryption_args)
 
 
+# pylint: disable=too-many-arguments
+@retry_pattern()
+def upload_part(s3_client, bucket, s3_key, upload_id, part_number, body):
+    response = s3_client.upload_part(Bucket=bucket, Key=s3_key, UploadId=upload_id,
+                                     PartNumber=part_number, Body=body)
+    return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+
+@retry_pattern()
+def complete_multipart_upload(s3_client, bucket, s3_key, upload_id, parts):
+    s3_client.complete_multipart_upload(Bucket=bucket, Key=s3_key, UploadId=upload_id,
+                                        MultipartUpload={'Parts': parts})
+
+
+class MultipartUploadWriter(io.BufferedIOBase):
+    """
+    Binary file object that streams everything written to it into an S3
+    multipart upload, one part at a time, without any local file
+    Compress if necessary
+    The upload is completed by close, or aborted by abort and on errors
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, s3_client, bucket, s3_key, compression=None,
+                 encryption_type=None, encryption_key=None, part_size=DEFAULT_PART_SIZE):
+        super().__init__()
+        self._compressor = None
+        if compression is not None and compression.lower() != "none":
+            if compression == "gzip":
+                self._compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+                s3_key = f'{s3_key}.gz'
+            else:
+                raise NotImplementedError(
+                    "Compression type '{}' is not supported. Expected: 'none' or 'gzip'".format(compression)
+                )
+        encryption_args, encryption_desc = get_encryption_args(encryption_type, encryption_key)
+
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.s3_key = s3_key
+        self.part_size = part_size
+        self._buffer = bytearray()
+        self._parts = []
+
+        LOGGER.info("Streaming to bucket %s at %s%s", bucket, s3_key, encryption_desc)
+        self._upload_id = s3_client.create_multipart_upload(
+            Bucket=bucket, Key=s3_key, **(encryption_args or {}))['UploadId']
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        if self._compressor is not None:
+            self._buffer += self._compressor.compress(data)
+        else:
+            self._buffer += data
+        if len(self._buffer) >= self.part_size:
+            self._upload_buffer()
+        return len(data)
+
+    def _upload_buffer(self):
+        self._parts.append(upload_part(self.s3_client, self.bucket, self.s3_key, self._upload_id,
+                                       len(self._parts) + 1, bytes(self._buffer)))
+        self._buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._compressor is not None:
+                self._buffer += self._compressor.flush()
+            # The last part can be smaller than the minimum part size
+            if self._buffer or not self._parts:
+                self._upload_buffer()
+            complete_multipart_upload(self.s3_client, self.bucket, self.s3_key, self._upload_id, self._parts)
+        except Exception:
+            self.abort()
+            raise
+        super().close()
+
+    def abort(self):
+        """Aborts the upload, S3 discards the parts uploaded so far"""
+        if self.closed:
+            return
+        LOGGER.warning("Aborting upload to bucket %s at %s", self.bucket, self.s3_key)
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.s3_key, UploadId=self._upload_id)
+        finally:
+            super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
 def upload_files(filenames: Iterator[Dict],
                  s3_client: BaseClient,
                  s3_bucket: str,
                  compression: Optional[str],
                  encryption_type: Optional[str],
                  encryption_key: Optional[str],
-                 to_parquet: Optional[bool]):
+                 max_workers: Optional[int] = None):
     """
-    Uploads given local files to s3
+    Uploads given local files to s3 in parallel
     Compress if necessary
     """
-    for file in filenames:
-        filename, target_key = file['filename'], file['target_key']
-        if not os.path.exists(filename):
-            continue
-        compressed_file = None
-        if to_parquet:
-            filename = transform_csv_to_parquet(filename)
-            target_key = target_key.split(".csv")[0] + ".parquet"
-        if compression is not None and compression.lower() != "none":
-            if compression == "gzip":
-                compressed_file = f"{filename}.gz"
-                target_key = f'{target_key}.gz'
+    with ThreadPoolExecutor(max_workers=max_workers or DEFAULT_UPLOAD_WORKERS) as executor:
+        futures = [
+            executor.submit(upload_local_file, file, s3_client, s3_bucket, compression,
+                            encryption_type, encryption_key)
+            for file in filenames
+        ]
+        # Re-raise the first exception of the uploads, if any
+        for future in futures:
+            future.result()
 
-                with open(filename, 'rb') as f_in:
-                    with gzip.open(compressed_file, 'wb') as f_out:
-                        LOGGER.info(f"Compressing file as '%s'", compressed_file)
-                        shutil.copyfileobj(f_in, f_out)
 
-            else:
-                raise NotImplementedError(
-                    "Compression type '{}' is not supported. Expected: 'none' or 'gzip'".format(compression)
+# pylint: disable=too-many-arguments
+def upload_local_file(file: Dict,
+                      s3_client: BaseClient,
+                      s3_bucket: str,
+                      compression: Optional[str],
+                      encryption_type: Optional[str],
+                      encryption_key: Optional[str]):
+    """
+    Uploads a single local file to s3 and removes it
+    Compress if necessary
+    """
+    filename, target_key = file['filename'], file['target_key']
+    if not os.path.exists(filename):
+        return
+    compressed_file = None
+    if compression is not None and compression.lower() != "none":
+        if compression == "gzip":
+            compressed_file = f"{filename}.gz"
+            target_key = f'{target_key}.gz'
+
+            with open(filename, 'rb') as f_in:
+                with gzip.open(compressed_file, 'wb') as f_out:
+                    LOGGER.info("Compressing file as '%s'", compressed_file)
+                    shutil.copyfileobj(f_in, f_out)
+
+        else:
+            raise NotImplementedError(
+                "Compression type '{}' is not supported. Expected: 'none' or 'gzip'".format(compression)
+            )
+
+    upload_file(compressed_file or filename,
+                s3_client,
+                s3_bucket,
+                target_key,
+                encryption_type=encryption_type,
+                encryption_key=encryption_key
                 )
 
-        upload_file(compressed_file or filename,
-                    s3_client,
-                    s3_bucket,
-                    target_key,
-                    encryption_type=encryption_type,
-                    encryption_key=encryption_key
-                    )
-
-        # Remove the local file(s)
-        if os.path.exists(filename):
-            os.remove(filename)
-            if compressed_file:
-                os.remove(compressed_file)
-
-
-def transform_csv_to_parquet(filename):
-    table = pa_csv.read_csv(filename)
-    filename_parquet = filename.split(".csv")[0] + ".parquet"
-    parquet.write_table(table, filename_parquet)
-    os.remove(filename)
-    return filename_parquet
+    # Remove the local file(s)
+    if os.path.exists(filename):
+        os.remove(filename)
+        if compressed_file:
+            os.remove(compressed_file)
+
@@ -7,7 +7,7 @@ import re
 import inflection
 
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timezone
 from collections.abc import MutableMapping
 
 logger = singer.get_logger('target_s3_csv')
@@ -57,22 +57,28 @@ def add_metadata_values_to_record(record_message, schema_message, timestamp=None
     """
     extended_record = record_message['record']
     if not timestamp:
-        timestamp = datetime.now().isoformat()
+        timestamp = datetime.now(timezone.utc).isoformat()
     extended_record['_sdc_batched_at'] = timestamp
     return extended_record
 
 
+METADATA_COLUMNS = (
+    '_sdc_batched_at',
+    '_sdc_deleted_at',
+    '_sdc_extracted_at',
+    '_sdc_primary_key',
+    '_sdc_received_at',
+    '_sdc_sequence',
+    '_sdc_table_version',
+)
+
+
 def remove_metadata_values_from_record(record_message):
     """Removes every metadata _sdc column from a given record message
     """
     cleaned_record = record_message['record']
-    cleaned_record.pop('_sdc_batched_at', None)
-    cleaned_record.pop('_sdc_deleted_at', None)
-    cleaned_record.pop('_sdc_extracted_at', None)
-    cleaned_record.pop('_sdc_primary_key', None)
-    cleaned_record.pop('_sdc_received_at', None)
-    cleaned_record.pop('_sdc_sequence', None)
-    cleaned_record.pop('_sdc_table_version', None)
+    for column in METADATA_COLUMNS:
+        cleaned_record.pop(column, None)
 
     return cleaned_record
 
@@ -112,6 +118,75 @@ def flatten_record(d, parent_key=None, sep='__'):
     return dict(items)
 
 
+def compile_flatten_plan(schema, parent_key=None, sep='__', exclude=()):
+    """Pre-computes the flattened column names of a JSON schema
+
+    Returns a dictionary of property name -> (flattened key, nested plan) in the
+    same order as flatten_record would produce them. Nested plans are only built
+    for object properties that define their own properties.
+    """
+    if parent_key is None:
+        parent_key = []
+
+    properties = schema.get('properties') or {}
+    plan = {}
+    for k in sorted(properties.keys()):
+        if k in exclude:
+            continue
+        v = properties[k]
+        if isinstance(v, MutableMapping) and v.get('properties'):
+            plan[k] = (flatten_key(k, parent_key, sep), compile_flatten_plan(v, parent_key + [k], sep))
+        else:
+            plan[k] = (flatten_key(k, parent_key, sep), None)
+    return plan
+
+
+def flatten_schema(schema, parent_key=None, sep='__', exclude=()):
+    """Flattens the properties of a JSON schema the same way as flatten_record
+    flattens records
+
+    Returns a dictionary of flattened key -> property schema.
+    """
+    if parent_key is None:
+        parent_key = []
+
+    properties = schema.get('properties') or {}
+    items = {}
+    for k in sorted(properties.keys()):
+        if k in exclude:
+            continue
+        v = properties[k]
+        if isinstance(v, MutableMapping) and v.get('properties'):
+            items.update(flatten_schema(v, parent_key + [k], sep))
+        else:
+            items[flatten_key(k, parent_key, sep)] = v
+    return items
+
+
+def flatten_record_with_plan(d, plan, parent_key=None, sep='__'):
+    """Flattens a record with a plan built by compile_flatten_plan
+
+    Every column of the plan is returned, missing values as None. Falls back to
+    flatten_record for records and free-form objects not covered by the plan.
+    """
+    if parent_key is None:
+        parent_key = []
+
+    if not d.keys() <= plan.keys():
+        return flatten_record(d, parent_key, sep=sep)
+
+    items = {}
+    for k, (new_key, nested_plan) in plan.items():
+        v = d.get(k)
+        if nested_plan is not None and (v is None or isinstance(v, MutableMapping)):
+            items.update(flatten_record_with_plan(v or {}, nested_plan, parent_key + [k], sep=sep))
+        elif isinstance(v, MutableMapping):
+            items.update(flatten_record(v, parent_key + [k], sep=sep))
+        else:
+            items[new_key] = json.dumps(v, use_decimal=True) if type(v) is list else v
+    return items
+
+
 def get_target_key(message, prefix=None, timestamp=None, naming_convention=None, format=".csv"):
     """Creates and returns an S3 key for the message"""
     if not naming_convention:
@@ -1,6 +1,6 @@
 import os
 import unittest
-import simplejson
+import orjson
 import botocore
 import botocore.exceptions
 
@@ -48,7 +48,7 @@ class TestIntegration(unittest.TestCase):
     def test_invalid_json(self):
         """Receiving invalid JSONs should raise an exception"""
         tap_lines = test_utils.get_test_tap_lines('invalid-json.json')
-        with self.assertRaises(simplejson.scanner.JSONDecodeError):
+        with self.assertRaises(orjson.JSONDecodeError):
             self.persist_messages(tap_lines)
 
     def test_message_order(self):
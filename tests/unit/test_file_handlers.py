@@ -0,0 +1,141 @@
+import csv
+import io
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import Mock, patch
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from target_s3_csv.file_handlers import ParquetFileHandler, create_arrow_schema, create_row_formatter
+
+
+class TestFileHandlers(unittest.TestCase):
+    """
+    Unit Tests for file_handlers module
+    """
+
+    def assert_same_as_dict_writer(self, header, records, delimiter=',', quotechar='"'):
+        format_row = create_row_formatter(header, delimiter, quotechar)
+        for record in records:
+            expected = io.StringIO(newline='')
+            csv.DictWriter(expected, header, extrasaction='ignore',
+                           delimiter=delimiter, quotechar=quotechar).writerow(record)
+            self.assertEqual(expected.getvalue(), format_row(record))
+
+    def test_row_formatter_matches_dict_writer(self):
+        """Test that the generated row formatter writes the same lines as csv.DictWriter"""
+        header = ['id', 'name', 'score']
+        records = [
+            {'id': 1, 'name': 'Steve', 'score': 1.5},
+            {'id': 2, 'name': 'Peter, "Pete"', 'score': None},
+            {'id': 3, 'name': 'multi\nline'},
+            {'id': 4, 'name': '', 'score': True, 'extra': 'ignored'},
+        ]
+
+        self.assert_same_as_dict_writer(header, records)
+        self.assert_same_as_dict_writer(header, records, delimiter=';', quotechar="'")
+
+    def test_row_formatter_quotes_empty_single_column(self):
+        """Test that an empty field of a single column row is quoted like csv.DictWriter does"""
+        self.assert_same_as_dict_writer(['name'], [{'name': ''}, {'name': None}, {}, {'name': 'Steve'}])
+
+    def test_create_arrow_schema(self):
+        """Test that JSON schema types are mapped to compact arrow types"""
+        flattened_schema = {
+            'id': {'type': 'integer'},
+            'status': {'type': ['null', 'string'], 'enum': ['active', 'deleted']},
+            'updated_at': {'type': ['null', 'string'], 'format': 'date-time'},
+            'value': {'type': ['null', 'string', 'number']},
+            'anything': {},
+        }
+
+        self.assertEqual(
+            pa.schema([
+                ('id', pa.int64()),
+                ('status', pa.dictionary(pa.int32(), pa.string())),
+                ('updated_at', pa.timestamp('us', tz='UTC')),
+                ('value', pa.string()),
+                ('anything', pa.string()),
+            ]),
+            create_arrow_schema(flattened_schema)
+        )
+
+    def write_parquet(self, flattened_schema, records, row_group_count=None):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, 'stream.parquet')
+            target = Mock(stream_upload=False, filenames={'stream': {'filename': filename}})
+            file_handler = ParquetFileHandler(target)
+            file_handler.set_schema('stream', flattened_schema)
+            for record in records:
+                file_handler.write_record_to_file('stream', filename, record)
+            file_handler.close()
+            if row_group_count is not None:
+                self.assertEqual(row_group_count, pq.ParquetFile(filename).num_row_groups)
+            return pq.read_table(filename).to_pylist()
+
+    def test_parquet_file_handler_writes_values_outside_the_schema_types(self):
+        """Test that timestamps with nanoseconds, invalid date-times and values outside the enum are written"""
+        flattened_schema = {
+            'updated_at': {'type': ['null', 'string'], 'format': 'date-time'},
+            'status': {'type': ['null', 'string'], 'enum': ['active', 'deleted']},
+        }
+        records = [{'updated_at': '2021-01-01T00:00:00.1234567Z', 'status': 'status-0'},
+                   {'updated_at': '2021-01-01T00:00:00.123456789+00:00', 'status': 'active'},
+                   {'updated_at': 'not a date', 'status': None}]
+        records += [{'updated_at': None, 'status': 'status-{}'.format(i)} for i in range(200)]
+
+        rows = self.write_parquet(flattened_schema, records)
+
+        self.assertEqual(datetime(2021, 1, 1, 0, 0, 0, 123456, tzinfo=timezone.utc), rows[0]['updated_at'])
+        self.assertEqual(datetime(2021, 1, 1, 0, 0, 0, 123456, tzinfo=timezone.utc), rows[1]['updated_at'])
+        self.assertIsNone(rows[2]['updated_at'])
+        self.assertEqual(['status-0', 'active', None] + ['status-{}'.format(i) for i in range(200)],
+                         [row['status'] for row in rows])
+
+    @patch('target_s3_csv.file_handlers.ROW_GROUP_SIZE', 1)
+    def test_parquet_file_handler_writes_untyped_columns_as_json(self):
+        """Test that untyped columns and columns not in the schema keep one type across row groups"""
+        records = [{'x': None, 'extra': None}, {'x': 1, 'extra': None}, {'x': 'a', 'extra': True}, {'x': 2.5, 'extra': [1]}]
+
+        rows = self.write_parquet({'x': {}}, records)
+
+        self.assertEqual([None, '1', 'a', '2.5'], [row['x'] for row in rows])
+        self.assertEqual([None, None, 'true', '[1]'], [row['extra'] for row in rows])
+
+    def test_parquet_file_handler_converts_values_of_another_type(self):
+        """Test that values the arrow JSON reader rejects are converted and columns that cannot hold them become strings"""
+        flattened_schema = {
+            'id': {'type': 'integer'},
+            'big': {'type': ['null', 'integer']},
+            'name': {'type': ['null', 'string']},
+            'flag': {'type': ['null', 'boolean']},
+        }
+        records = [{'id': 1.0, 'big': 1, 'name': 5, 'flag': 'true'},
+                   {'id': 2, 'big': 123456789012345678901234567890, 'name': 'x', 'flag': False}]
+
+        rows = self.write_parquet(flattened_schema, records)
+
+        self.assertEqual([{'id': 1, 'big': '1', 'name': '5', 'flag': True},
+                          {'id': 2, 'big': '123456789012345678901234567890', 'name': 'x', 'flag': False}], rows)
+
+    @patch('target_s3_csv.file_handlers.ROW_GROUP_SIZE', 1)
+    def test_parquet_file_handler_writes_nulls_for_values_of_another_type_in_later_row_groups(self):
+        """Test that values that do not fit the schema of an open file are written as nulls"""
+        flattened_schema = {'id': {'type': 'integer'}, 'flag': {'type': ['null', 'boolean']}}
+        records = [{'id': 1, 'flag': True}, {'id': 1.0, 'flag': 'yes'}, {'id': 2 ** 70, 'flag': 'false'}]
+
+        rows = self.write_parquet(flattened_schema, records)
+
+        self.assertEqual([{'id': 1, 'flag': True}, {'id': 1, 'flag': None}, {'id': None, 'flag': False}], rows)
+
+    @patch('target_s3_csv.file_handlers.ROW_GROUP_BUFFER_SIZE', 40)
+    def test_parquet_file_handler_limits_row_group_buffer_size(self):
+        """Test that a row group is written once its buffered JSON reaches the size limit"""
+        records = [{'id': 1, 'text': 'a' * 30}, {'id': 2, 'text': 'b'}, {'id': 3, 'text': 'c'}]
+
+        rows = self.write_parquet({'id': {'type': 'integer'}, 'text': {'type': 'string'}}, records, row_group_count=2)
+
+        self.assertEqual([1, 2, 3], [row['id'] for row in rows])
@@ -1,14 +1,17 @@
 import contextlib
 import io
 import json
+import os
+import tempfile
 import unittest
 
 from unittest.mock import patch, Mock
 
+import orjson
 import pytest
 from botocore.client import BaseClient
 
-from target_s3_csv import emit_state, TargetS3Parquet
+from target_s3_csv import _FORMAT_CHECKER, emit_state, parse_message, TargetS3Parquet
 
 
 MESSAGES = [
@@ -50,11 +53,32 @@ class TestMain(unittest.TestCase):
             emit_state({'a': 1, 'b': 2, 'c': 'lool'})
             self.assertEqual('{"a": 1, "b": 2, "c": "lool"}\n', f.getvalue())
 
+    def test_parse_message_returns_dictionary(self):
+        self.assertDictEqual(
+            {"type": "RECORD", "stream": "my_stream", "record": {"id": 1}},
+            parse_message('{"type": "RECORD", "stream": "my_stream", "record": {"id": 1}}')
+        )
+
+    def test_parse_message_keeps_exact_numbers(self):
+        message = parse_message('{"type": "RECORD", "stream": "my_stream", "record": '
+                                '{"big": 123456789012345678901234567890, "amt": 12345678901234567.89, "price": 1.10}}')
+        self.assertEqual(123456789012345678901234567890, message['record']['big'])
+        self.assertEqual('12345678901234567.89', str(message['record']['amt']))
+        self.assertEqual('1.10', str(message['record']['price']))
+
+    def test_parse_message_with_invalid_json_raises_orjson_error(self):
+        for message in ('THIS IS A TEST INPUT', '{"type": "RECORD", "record": {"amt": 1.5,', '{"big": 123456789012345678901234567890'):
+            with self.assertRaises(orjson.JSONDecodeError):
+                parse_message(message)
+
+    def test_parse_message_with_missing_key_raises_exception(self):
+        with self.assertRaises(Exception):
+            parse_message('{"type": "RECORD", "record": {"id": 1}}')
+
     @patch('target_s3_csv.file_handlers.open')
-    @patch('target_s3_csv.file_handlers.csv')
     @patch('target_s3_csv.s3')
     @patch('target_s3_csv.os')
-    def test_persist_messages(self, os, s3, csv, open):
+    def test_persist_messages(self, os, s3, open):
         s3_client = Mock(spec_set=BaseClient)
         target = TargetS3Parquet(self.config, s3_client)
         state = target.persist_messages(MESSAGES)
@@ -62,5 +86,68 @@ class TestMain(unittest.TestCase):
         s3.upload_files.assert_called_once()
 
 
+    def test_persist_messages_aborts_streamed_uploads_on_error(self):
+        s3_client = Mock(**{'create_multipart_upload.return_value': {'UploadId': 'upload-id'}})
+        target = TargetS3Parquet(dict(self.config, stream_upload=True), s3_client)
+        unknown_stream = json.dumps({"type": "RECORD", "stream": "unknown_stream", "record": {"id": 5}})
+
+        with self.assertRaises(Exception):
+            target.persist_messages(MESSAGES + [unknown_stream])
+
+        s3_client.abort_multipart_upload.assert_called_once()
+        s3_client.complete_multipart_upload.assert_not_called()
+
+    @patch('target_s3_csv.file_handlers.ROW_BUFFER_SIZE', 2)
+    @patch('target_s3_csv.s3.upload_files')
+    def test_persist_messages_writes_csv_files(self, upload_files):
+        uploaded = []
+
+        def read_files(filenames, *args):
+            for file in filenames:
+                with open(file['filename'], 'rb') as csvfile:
+                    uploaded.append(csvfile.read())
+                os.remove(file['filename'])
+        upload_files.side_effect = read_files
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            target = TargetS3Parquet({**self.config, 'temp_dir': temp_dir, 'default_batch_size': 3},
+                                     Mock(spec_set=BaseClient))
+            target.persist_messages(MESSAGES)
+
+        self.assertEqual([b'age,id,name\r\n10,1,Steve\r\n33,2,Peter\r\n25,3,Pete\r\n',
+                          b'age,id,name\r\n40,4,John\r\n'], uploaded)
+
+    def test_get_validator_reuses_validator_for_identical_schemas(self):
+        target = TargetS3Parquet(self.config, Mock(spec_set=BaseClient))
+        validator = target.get_validator({"properties": {"id": {"type": "integer"}, "name": {"type": "string"}}})
+        self.assertIs(validator,
+                      target.get_validator({"properties": {"name": {"type": "string"}, "id": {"type": "integer"}}}))
+
+    def test_format_checker_checks_dates(self):
+        for instance in ('2019-02-01T15:12:45Z', '2019-02-01T15:12:45.123456+02:00', '2019-02-01 15:12:45Z'):
+            self.assertTrue(_FORMAT_CHECKER.conforms(instance, 'date-time'), instance)
+        for instance in ('2019-02-01', '2019-02-31T15:12:45Z', '2019-02-01T15:12:45', 'not a date'):
+            self.assertFalse(_FORMAT_CHECKER.conforms(instance, 'date-time'), instance)
+        self.assertTrue(_FORMAT_CHECKER.conforms('2019-02-01', 'date'))
+        for instance in ('2019-02-31', '2019-02-01T15:12:45Z', 'not a date'):
+            self.assertFalse(_FORMAT_CHECKER.conforms(instance, 'date'), instance)
+        for instance in (None, 1, 1.5, True):
+            self.assertTrue(_FORMAT_CHECKER.conforms(instance, 'date-time'))
+            self.assertTrue(_FORMAT_CHECKER.conforms(instance, 'date'))
+
+    def test_validate_message_with_skip_validation_does_nothing(self):
+        target = TargetS3Parquet({**self.config, 'skip_validation': True}, Mock(spec_set=BaseClient))
+        target.validators['my_stream'] = Mock()
+        target.validate_message({"type": "RECORD", "stream": "my_stream", "record": {"id": 1}})
+        target.validators['my_stream'].validate.assert_not_called()
+
+    def test_process_message_schema_skips_identical_schema(self):
+        target = TargetS3Parquet({**self.config, 'add_metadata_columns': True}, Mock(spec_set=BaseClient))
+        with patch.object(target, 'get_validator', wraps=target.get_validator) as get_validator:
+            target.process_message_schema(json.loads(MESSAGES[0]))
+            target.process_message_schema(json.loads(MESSAGES[0]))
+        get_validator.assert_called_once()
+        self.assertIn('_sdc_batched_at', target.schemas['my_stream']['properties'])
+
     def test_record_to_df(self):
         ...
@@ -42,7 +42,6 @@ class TestS3(unittest.TestCase):
             'my_bucket',
             None,
             None,
-            None,
             None
         )
 
@@ -52,7 +51,8 @@ class TestS3(unittest.TestCase):
                 call(file1.name, 'my_bucket', 'folder1/file.csv', ExtraArgs=None),
                 call(file2.name, 'my_bucket', 'folder2/file.csv', ExtraArgs=None),
                 call(file3.name, 'my_bucket', 'folder3/file.csv', ExtraArgs=None),
-            ]
+            ],
+            any_order=True
         )
 
         # make sure that the upload_files function removed the files
@@ -81,7 +81,6 @@ class TestS3(unittest.TestCase):
             'my_bucket',
             'gzip',
             None,
-            None,
             None
 
         )
@@ -92,7 +91,8 @@ class TestS3(unittest.TestCase):
                 call(f'{file1.name}.gz', 'my_bucket', 'folder1/file.csv.gz', ExtraArgs=None),
                 call(f'{file2.name}.gz', 'my_bucket', 'folder2/file.csv.gz', ExtraArgs=None),
                 call(f'{file3.name}.gz', 'my_bucket', 'folder3/file.csv.gz', ExtraArgs=None),
-            ]
+            ],
+            any_order=True
         )
 
         # make sure that the upload_files function removed the files
@@ -121,7 +121,6 @@ class TestS3(unittest.TestCase):
             'my_bucket',
             None,
             'kms',
-            None,
             None
 
         )
@@ -132,10 +131,64 @@ class TestS3(unittest.TestCase):
                 call(f'{file1.name}', 'my_bucket', 'folder1/file.csv', ExtraArgs={'ServerSideEncryption': 'aws:kms'}),
                 call(f'{file2.name}', 'my_bucket', 'folder2/file.csv', ExtraArgs={'ServerSideEncryption': 'aws:kms'}),
                 call(f'{file3.name}', 'my_bucket', 'folder3/file.csv', ExtraArgs={'ServerSideEncryption': 'aws:kms'}),
-            ]
+            ],
+            any_order=True
         )
 
         # make sure that the upload_files function removed the files
         self.assertFalse(os.path.exists(file1.name))
         self.assertFalse(os.path.exists(file2.name))
         self.assertFalse(os.path.exists(file3.name))
+
+    def test_multipart_upload_writer_uploads_parts(self):
+        s3_client = Mock(**{
+            'create_multipart_upload.return_value': {'UploadId': 'upload-id'},
+            'upload_part.side_effect': [{'ETag': 'etag-1'}, {'ETag': 'etag-2'}],
+        })
+
+        writer = s3.MultipartUploadWriter(s3_client, 'my_bucket', 'folder1/file.csv', encryption_type='kms',
+                                          part_size=4)
+        writer.write(b'abcde')
+        writer.write(b'fg')
+        writer.close()
+
+        s3_client.create_multipart_upload.assert_called_once_with(
+            Bucket='my_bucket', Key='folder1/file.csv', ServerSideEncryption='aws:kms')
+        s3_client.upload_part.assert_has_calls(
+            [
+                call(Bucket='my_bucket', Key='folder1/file.csv', UploadId='upload-id', PartNumber=1, Body=b'abcde'),
+                call(Bucket='my_bucket', Key='folder1/file.csv', UploadId='upload-id', PartNumber=2, Body=b'fg'),
+            ]
+        )
+        s3_client.complete_multipart_upload.assert_called_once_with(
+            Bucket='my_bucket', Key='folder1/file.csv', UploadId='upload-id',
+            MultipartUpload={'Parts': [{'ETag': 'etag-1', 'PartNumber': 1}, {'ETag': 'etag-2', 'PartNumber': 2}]})
+
+    def test_multipart_upload_writer_aborts_on_error(self):
+        s3_client = Mock(**{
+            'create_multipart_upload.return_value': {'UploadId': 'upload-id'},
+            'upload_part.side_effect': ValueError('upload failed'),
+        })
+
+        writer = s3.MultipartUploadWriter(s3_client, 'my_bucket', 'folder1/file.csv')
+        writer.write(b'abc')
+        with self.assertRaises(ValueError):
+            writer.close()
+
+        s3_client.abort_multipart_upload.assert_called_once_with(
+            Bucket='my_bucket', Key='folder1/file.csv', UploadId='upload-id')
+        s3_client.complete_multipart_upload.assert_not_called()
+        self.assertTrue(writer.closed)
+
+    def test_multipart_upload_writer_context_manager_aborts_on_exception(self):
+        s3_client = Mock(**{'create_multipart_upload.return_value': {'UploadId': 'upload-id'}})
+
+        with self.assertRaises(KeyError):
+            with s3.MultipartUploadWriter(s3_client, 'my_bucket', 'folder1/file.csv') as writer:
+                writer.write(b'abc')
+                raise KeyError('stream')
+
+        s3_client.abort_multipart_upload.assert_called_once_with(
+            Bucket='my_bucket', Key='folder1/file.csv', UploadId='upload-id')
+        s3_client.upload_part.assert_not_called()
+        s3_client.complete_multipart_upload.assert_not_called()
@@ -59,3 +59,58 @@ class TestUtils(unittest.TestCase):
                                       naming_convention='folder1/test_{stream}_test.csv')
 
         self.assertEqual('folder1/the_prefix__test_the_stream_test.csv', s3_key)
+
+    def test_flatten_record_with_plan_matches_flatten_record(self):
+        """Test that a compiled flatten plan produces the same columns as flatten_record"""
+        schema = {
+            'properties': {
+                'id': {'type': 'integer'},
+                'tags': {'type': 'array'},
+                'address': {
+                    'type': 'object',
+                    'properties': {
+                        'city': {'type': 'string'},
+                        'zip': {'type': 'string'}
+                    }
+                },
+                'extra': {'type': 'object'}
+            }
+        }
+        record = {'id': 1, 'tags': ['a', 'b'], 'address': {'city': 'London', 'zip': 'N1'}, 'extra': {'x': 1}}
+        plan = utils.compile_flatten_plan(schema)
+
+        self.assertEqual(list(utils.flatten_record(record).items()),
+                         list(utils.flatten_record_with_plan(record, plan).items()))
+
+    def test_flatten_record_with_plan_handles_missing_and_unknown_keys(self):
+        """Test that missing columns are None and unknown columns fall back to flatten_record"""
+        plan = utils.compile_flatten_plan({'properties': {'id': {'type': 'integer'}, 'name': {'type': 'string'}}})
+
+        self.assertEqual({'id': 1, 'name': None}, utils.flatten_record_with_plan({'id': 1}, plan))
+        self.assertEqual({'id': 1, 'other': 2}, utils.flatten_record_with_plan({'id': 1, 'other': 2}, plan))
+
+    def test_flatten_record_with_plan_keeps_non_object_values_of_object_properties(self):
+        """Test that a scalar value of a property with nested properties is kept like flatten_record does"""
+        plan = utils.compile_flatten_plan({
+            'properties': {
+                'obj': {'type': ['null', 'object', 'string'], 'properties': {'a': {'type': 'string'}}}
+            }
+        })
+
+        self.assertEqual({'obj': 'abc'}, utils.flatten_record_with_plan({'obj': 'abc'}, plan))
+        self.assertEqual({'obj': '[1, 2]'}, utils.flatten_record_with_plan({'obj': [1, 2]}, plan))
+        self.assertEqual({'obj__a': 'x'}, utils.flatten_record_with_plan({'obj': {'a': 'x'}}, plan))
+        self.assertEqual({'obj__a': None}, utils.flatten_record_with_plan({'obj': None}, plan))
+
+    def test_flatten_schema(self):
+        """Test that nested object properties are flattened like records"""
+        schema = {
+            'properties': {
+                'id': {'type': 'integer'},
+                'address': {'type': 'object', 'properties': {'city': {'type': 'string'}}},
+                '_sdc_deleted_at': {'type': ['null', 'string']}
+            }
+        }
+
+        self.assertEqual({'address__city': {'type': 'string'}, 'id': {'type': 'integer'}},
+                         utils.flatten_schema(schema, exclude=utils.METADATA_COLUMNS))